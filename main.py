@@ -1,32 +1,47 @@
-import requests
-from bs4 import BeautifulSoup
 import openai
+import httpx
 import smtplib
 from email.message import EmailMessage
 import sqlite3
-import schedule
 import time
 import os
 import re
-# 🧠 Selenium Imports
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+import hashlib
+import math
+import threading
+import atexit
+import asyncio
+import functools
+import json
 
 print("✅ main.py started", flush=True)
 
 
 # === إعداد المفاتيح والبيئة ===
 SPA_URL = "https://www.spa.gov.sa/en/news/latest-news?page=1"
-openai.api_key = os.environ["OPENAI_API_KEY"]
+# عميل واحد يعيد استخدام اتصالات HTTP، بحدود واضحة للـ pool
+# (الـ SDK يرسل timeout الخاص به مع كل طلب، فيجب تمرير Timeout الكامل هنا وليس في httpx.Client فقط)
+OPENAI_TIMEOUT = httpx.Timeout(30, connect=5)
+OPENAI_HTTP = httpx.Client(
+    limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+    timeout=OPENAI_TIMEOUT,
+)
+OPENAI_CLIENT = openai.OpenAI(
+    api_key=os.environ["OPENAI_API_KEY"],
+    http_client=OPENAI_HTTP,
+    max_retries=2,  # نفس القيمة الافتراضية في الـ SDK
+    timeout=OPENAI_TIMEOUT,
+)
 EMAIL_SENDER = os.environ["EMAIL_SENDER"]
 EMAIL_PASSWORD = os.environ["EMAIL_PASSWORD"]
 EMAIL_RECEIVER = os.environ["EMAIL_RECEIVER"]
 SMTP_SERVER = "smtp.gmail.com"
 SMTP_PORT = 587
 DB_FILE = "visited_news.db"
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4")  # مثال: gpt-4o-mini لزمن استجابة أقل
+MIN_CONTENT_CHARS = 200  # أقل من ذلك يعني غالبًا أن الاستخراج فشل
+GRAMMAR_SKIPPED = "Grammar check skipped (content too short)"
+DEBUG = os.environ.get("SPA_DEBUG") == "1"  # حفظ صفحات HTML للمراجعة فقط عند التفعيل
 
 
 EXCLUDED_WORDS = [
@@ -46,6 +61,17 @@ EXCLUDED_WORDS = [
     "Public Consultation Platform"
 ]
 
+# تعبير واحد مُجمَّع يحذف كل العبارات المستثناة (الأطول أولًا)
+EXCLUDED_RE = re.compile("|".join(
+    re.escape(phrase) for phrase in sorted(EXCLUDED_WORDS, key=len, reverse=True)
+))
+# تذييلات حقوق النشر المتكررة في آخر الخبر: سطر قصير يبدأ بـ ©/Copyright أو يحتوي
+# "All rights reserved" (الفقرات الطويلة التي تقتبس العبارة تبقى كما هي)
+FOOTER_RE = re.compile(
+    r"^(?=.{0,120}$)[ \t]*(?:©|\(c\)|copyright\b|.*\ball rights reserved\b).*$",
+    re.IGNORECASE | re.MULTILINE
+)
+
 # ✅ Table A: Official Names and Titles
 TABLE_A_NAMES = [
     "Custodian of the Two Holy Mosques King Salman bin Abdulaziz Al Saud",
@@ -78,6 +104,8 @@ TABLE_A_NAMES = [
     "Vice Minister of Foreign Affairs Waleed Elkhereiji"
 ]
 
+TABLE_A_NAMES_LOWER = [(name, name.lower()) for name in TABLE_A_NAMES]
+
 # ✅ Table B: Regions and Common Mistakes
 TABLE_B_NAMES = {
     "Riyadh": ["Riyadh city", "Riyadh City"],
@@ -95,103 +123,274 @@ TABLE_B_NAMES = {
     "Northern Borders": ["Northern Borders Region", "Northern Province", "Northern Border"]
 }
 
+# === Bloom Filter أمام جدول visited ===
+class BloomFilter:
+    """
+    فلتر احتمالي في الذاكرة: إذا قال إن الرابط غير موجود فهو غير موجود قطعًا،
+    وإذا قال موجود نتأكد من SQLite. حجمه يُحسب من السعة ونسبة الخطأ المطلوبة.
+    """
+
+    def __init__(self, capacity=10000, error_rate=0.001):
+        self.capacity = capacity
+        self.count = 0
+        # الحجم الأمثل: m = -n·ln(p) / ln(2)², k = (m/n)·ln(2)
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing (Kirsch–Mitzenmacher): hash واحد يولّد k مواقع
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def is_full(self):
+        return self.count > self.capacity
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+VISITED_BLOOM = BloomFilter()
+BLOOM_MIN_CAPACITY = 10000
+
 # === تهيئة قاعدة البيانات ===
+# اتصال واحد طوال عمر البرنامج؛ يُستخدم من threads مختلفة (asyncio.to_thread) لذلك يُحمى بقفل
+DB_CONN = None
+DB_LOCK = threading.Lock()
+
+def get_db():
+    # يُستدعى والقفل DB_LOCK محجوز
+    global DB_CONN
+    if DB_CONN is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        # الإعدادات تُطبَّق مرة واحدة: fsync أقل مع WAL، والجداول المؤقتة في الذاكرة
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        DB_CONN = conn
+    return DB_CONN
+
+def close_db():
+    global DB_CONN
+    with DB_LOCK:
+        if DB_CONN is not None:
+            DB_CONN.close()
+            DB_CONN = None
+
+atexit.register(close_db)
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS visited (url TEXT PRIMARY KEY)")
-    conn.commit()
-    conn.close()
-
-def is_visited(url):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM visited WHERE url = ?", (url,))
-    result = cur.fetchone()
-    conn.close()
-    return result is not None
-
-def mark_visited(url):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO visited (url) VALUES (?)", (url,))
-    conn.commit()
-    conn.close()
+    with DB_LOCK:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS visited (url TEXT PRIMARY KEY)")
+        cur.execute("CREATE TABLE IF NOT EXISTS grammar_cache (h BLOB PRIMARY KEY, result TEXT, ts INTEGER)")
+        # قواعد بيانات قديمة أُنشئ فيها الجدول بدون عمود ts
+        columns = [row[1] for row in cur.execute("PRAGMA table_info(grammar_cache)")]
+        if "ts" not in columns:
+            cur.execute("ALTER TABLE grammar_cache ADD COLUMN ts INTEGER")
+        conn.commit()
+    load_visited_bloom()
+
+def load_visited_bloom():
+    # بناء الفلتر من الروابط المحفوظة، بسعة ضعف عددها حتى يبقى هامش للروابط الجديدة
+    global VISITED_BLOOM
+    with DB_LOCK:
+        cur = get_db().cursor()
+        count = cur.execute("SELECT COUNT(*) FROM visited").fetchone()[0]
+        bloom = BloomFilter(capacity=max(BLOOM_MIN_CAPACITY, 2 * count))
+        for (url,) in cur.execute("SELECT url FROM visited"):
+            bloom.add(url)
+    VISITED_BLOOM = bloom
+
+def get_visited_set(urls):
+    # استعلام واحد لكل الروابط بدل استعلام لكل رابط، والفلتر يستبعد الجديد منها مسبقًا
+    candidates = [url for url in urls if url in VISITED_BLOOM]
+    if not candidates:
+        return set()
+    placeholders = ",".join("?" * len(candidates))
+    with DB_LOCK:
+        cur = get_db().cursor()
+        cur.execute(f"SELECT url FROM visited WHERE url IN ({placeholders})", candidates)
+        return {row[0] for row in cur.fetchall()}
+
+def mark_visited_many(urls):
+    # كل الروابط في معاملة واحدة (commit واحد)
+    with DB_LOCK:
+        conn = get_db()
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO visited (url) VALUES (?)", [(url,) for url in urls])
+    for url in urls:
+        VISITED_BLOOM.add(url)
+    # امتلأ الفلتر → نسبة الخطأ ترتفع، فنعيد بناءه بسعة أكبر
+    if VISITED_BLOOM.is_full():
+        load_visited_bloom()
+
+# === كاش نتائج فحص القواعد (مفتاحه بصمة المحتوى) ===
+GRAMMAR_CACHE_SIZE = 1000  # عدد النتائج المحفوظة في SQLite (الأحدث استخدامًا)
+
+def content_hash(content):
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+def get_cached_grammar(h):
+    with DB_LOCK:
+        cur = get_db().cursor()
+        cur.execute("SELECT result FROM grammar_cache WHERE h = ?", (h,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def touch_grammar(h):
+    # تحديث وقت آخر استخدام حتى يُحذف الأقل استخدامًا أولًا
+    with DB_LOCK:
+        conn = get_db()
+        conn.execute("UPDATE grammar_cache SET ts = ? WHERE h = ?", (int(time.time()), h))
+        conn.commit()
+
+def cache_grammar(h, result):
+    with DB_LOCK:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT OR REPLACE INTO grammar_cache (h, result, ts) VALUES (?, ?, ?)",
+            (h, result, int(time.time()))
+        )
+        # حذف الأقدم استخدامًا (LRU)
+        cur.execute(
+            "DELETE FROM grammar_cache WHERE h NOT IN "
+            "(SELECT h FROM grammar_cache ORDER BY ts DESC LIMIT ?)",
+            (GRAMMAR_CACHE_SIZE,)
+        )
+        conn.commit()
+
+@functools.lru_cache(maxsize=512)
+def cached_grammar_result(h):
+    # طبقة في الذاكرة أمام SQLite؛ عدم وجود النتيجة يُرفع كاستثناء حتى لا يُخزَّن في الكاش
+    result = get_cached_grammar(h)
+    if result is None:
+        raise KeyError(h)
+    return result
+
+def lookup_grammar(h):
+    # النتيجة قد تأتي من الذاكرة بدون المرور على SQLite، فنحدّث ts في كل الحالات
+    result = cached_grammar_result(h)
+    touch_grammar(h)
+    return result
+
+# === متصفح Selenium واحد يُعاد استخدامه بين الأخبار والدورات ===
+# (الاستدعاءات تتم خبرًا تلو الآخر، فلا يُستخدم المتصفح من أكثر من thread في نفس الوقت)
+DRIVER = None
+
+def get_driver():
+    global DRIVER
+    if DRIVER is None:
+        # 🧠 Selenium Imports (تُحمَّل فقط عند الحاجة لتسريع بدء التشغيل)
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
 
-# === جلب روابط الأخبار ===
-def get_latest_news_urls():
-    try:
         chrome_options = Options()
         chrome_options.add_argument("--headless")
         chrome_options.add_argument("--no-sandbox")
         chrome_options.add_argument("--disable-dev-shm-usage")
         chrome_options.add_argument("--disable-gpu")
         chrome_options.add_argument("--remote-debugging-port=9222")
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")  # لا حاجة لتحميل الصور
         chrome_options.binary_location = "/usr/bin/chromium"
         chrome_options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/112 Safari/537.36")
 
-        driver = webdriver.Chrome(options=chrome_options)
+        DRIVER = webdriver.Chrome(options=chrome_options)
+    return DRIVER
+
+def reset_driver():
+    # إغلاق المتصفح؛ الاستدعاء التالي لـ get_driver ينشئ متصفحًا جديدًا
+    global DRIVER
+    if DRIVER is not None:
+        try:
+            DRIVER.quit()
+        except Exception:
+            pass
+        DRIVER = None
+
+atexit.register(reset_driver)
+
+# === جلب روابط الأخبار ===
+# يرجع href لكل روابط الأخبار الحقيقية (التي تبدأ بـ /en/N) في طلب WebDriver واحد
+NEWS_LINKS_JS = (
+    "return Array.from(document.querySelectorAll(\"a[href^='/en/N']\"))"
+    ".map(e => e.href);"
+)
+
+def get_latest_news_urls():
+    try:
+        driver = get_driver()
         driver.get(SPA_URL)
         time.sleep(7)  # منح وقت كافٍ لتحميل الصفحة بالكامل
 
         # ✅ التقاط روابط الأخبار الحقيقية التي تبدأ بـ /en/N
-        elements = driver.find_elements(By.CSS_SELECTOR, "a[href^='/en/N']")
+        # (بدل get_attribute لكل عنصر، وهو طلب WebDriver منفصل لكل رابط)
         urls = []
 
-        for elem in elements:
-            href = elem.get_attribute("href")
+        for href in driver.execute_script(NEWS_LINKS_JS):
             if href:
                 full_url = href if href.startswith("http") else "https://www.spa.gov.sa" + href
                 urls.append(full_url)
 
         # حفظ الصفحة للمراجعة إذا لزم الأمر
-        with open("spa_page_debug.html", "w", encoding="utf-8") as f:
-            f.write(driver.page_source)
+        if DEBUG:
+            with open("spa_page_debug.html", "w", encoding="utf-8") as f:
+                f.write(driver.page_source)
 
-        driver.quit()
         print(f"✅ [Selenium] Found {len(urls)} news URLs", flush=True)
         return urls
     except Exception as e:
         print(f"❌ Selenium error: {e}", flush=True)
+        reset_driver()  # قد يكون المتصفح تعطل
         return []
     
 # === استخراج محتوى الخبر ===
+# قائمة احتمالات أماكن النص، مدمجة في CSS Selector واحد
+POSSIBLE_SELECTORS = [
+    "div.singleNewsText",
+    "div.newsContent",
+    "section.singleNewsText",
+    "article.singleNewsText",
+    "div.news_body",
+    "div.article-text",
+    "div.articleBody"
+]
+ARTICLE_SELECTOR = ", ".join(POSSIBLE_SELECTORS)
+
+# يرجع نصوص كل <p> داخل العنصر المُمرَّر (أو كل الصفحة إذا لم يُمرَّر عنصر)
+PARAGRAPH_TEXTS_JS = (
+    "return Array.from((arguments[0] || document).querySelectorAll('p'))"
+    ".map(e => e.innerText);"
+)
+
 def extract_news_content(url):
-    try:
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--disable-gpu")
-        chrome_options.add_argument("--remote-debugging-port=9223")
-        chrome_options.binary_location = "/usr/bin/chromium"
-        chrome_options.add_argument("user-agent=Mozilla/5.0")
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
 
-        driver = webdriver.Chrome(options=chrome_options)
+    try:
+        driver = get_driver()
         driver.get(url)
 
-        # قائمة احتمالات أماكن النص
-        possible_selectors = [
-            "div.singleNewsText",
-            "div.newsContent",
-            "section.singleNewsText",
-            "article.singleNewsText",
-            "div.news_body",
-            "div.article-text",
-            "div.articleBody"
-        ]
-
         article = None
-        # نحاول كل Selector حتى نجد النص
-        for selector in possible_selectors:
-            try:
-                WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, selector))
-                )
-                article = driver.find_element(By.CSS_SELECTOR, selector)
-                break
-            except:
-                continue
+        # انتظار واحد لأي من أماكن النص المحتملة (بدل 10 ثوانٍ لكل Selector)
+        try:
+            WebDriverWait(driver, 10).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, ARTICLE_SELECTOR))
+            )
+            article = driver.find_element(By.CSS_SELECTOR, ARTICLE_SELECTOR)
+        except:
+            pass
 
         # إذا لم نجد أي عنصر من القائمة، نعمل Fallback على كل <p>
         if not article:
@@ -203,30 +402,23 @@ def extract_news_content(url):
                 print(f"⚠️ Using fallback to scrape all <p> tags for {url}")
             except:
                 print(f"⚠️ No article container or <p> tags found for {url}")
-                with open("debug_page.html", "w", encoding="utf-8") as f:
-                    f.write(driver.page_source)
-                driver.quit()
+                if DEBUG:
+                    with open("debug_page.html", "w", encoding="utf-8") as f:
+                        f.write(driver.page_source)
                 return ""
 
-        # جمع الفقرات
-        if article == driver:  # fallback mode
-            paragraphs = driver.find_elements(By.TAG_NAME, "p")
-        else:
-            paragraphs = article.find_elements(By.TAG_NAME, "p")
-
-        # تنظيف النصوص: استبعاد الفقرات القصيرة والمكررة
-        seen = set()
-        content_lines = []
-        for p in paragraphs:
-            text = p.text.strip()
-            if len(text.split()) < 4:  # تجاهل الفقرات القصيرة جدًا
-                continue
-            if text and text not in seen:
-                seen.add(text)
-                content_lines.append(text)
+        # جمع نصوص الفقرات في طلب WebDriver واحد بدل طلب لكل فقرة
+        root = None if article == driver else article  # fallback mode → كل الصفحة
+        texts = driver.execute_script(PARAGRAPH_TEXTS_JS, root)
+
+        # تنظيف النصوص: استبعاد الفقرات القصيرة والمكررة (dict يحافظ على الترتيب)
+        # split بحد أقصى 3 يكفي لمعرفة هل في الفقرة 4 كلمات على الأقل
+        candidates = ((text or "").strip() for text in texts)
+        content_lines = list(dict.fromkeys(
+            t for t in candidates if len(t.split(None, 3)) == 4
+        ))
 
         content = "\n".join(content_lines)
-        driver.quit()
 
         if not content.strip():
             print(f"⚠️ No content extracted from: {url}", flush=True)
@@ -235,66 +427,107 @@ def extract_news_content(url):
 
     except Exception as e:
         print(f"❌ Selenium error while extracting content: {e}", flush=True)
+        reset_driver()  # قد يكون المتصفح تعطل
         return ""
 
 
 
 # === التحقق من الأخطاء اللغوية عبر ChatGPT ===
 # === فلترة التنبيهات غير المهمة في القواعد ===
+# مشاكل الترجمة أو التنسيق غير المؤثرة (تُحذف أيضًا من رد GPT سطرًا سطرًا)
+FORMATTING_KEYWORDS = (
+    "capitalized", "capitalize", "comma", "period", "punctuation", "space", "spacing",
+    "hyphen", "dash", "format", "date", "duplicate", "redundancy", "unclear",
+    "terms-and-conditions", "voice reader", "r101",
+)
+TRIVIAL_KEYWORDS = FORMATTING_KEYWORDS + (
+    # العبارات الشائعة من GPT
+    "a space is needed", "extra space", "could use punctuation",
+    "should have proper quotation marks", "should be revised for clarity",
+    "add a comma", "remove the extra asterisk", "separate it from",
+    "comma after", "congruent with", "corrected to a standard format",
+)
+# بحث واحد بتعبير مُجمَّع بدل lower() + فحص كل كلمة على حدة
+TRIVIAL_RE = re.compile("|".join(map(re.escape, TRIVIAL_KEYWORDS)), re.IGNORECASE)
+IGNORED_ISSUE_RE = re.compile("|".join(map(re.escape, FORMATTING_KEYWORDS)), re.IGNORECASE)
+FALSE_POSITIVE_RATIO = 0.7
+
+
 def is_false_positive_grammar(result):
     """
     تعود True إذا كانت كل أو أغلب الملاحظات تافهة ولا تستحق التنبيه.
     """
-    ignore_keywords = [
-        # مشاكل الترجمة أو التنسيق غير المؤثرة
-        "capitalized", "capitalize", "comma", "period", "punctuation", "space", "spacing",
-        "hyphen", "dash", "format", "date", "duplicate", "redundancy", "unclear",
-        "terms-and-conditions", "voice reader", "r101",
-        # العبارات الشائعة من GPT
-        "a space is needed", "extra space", "could use punctuation",
-        "should have proper quotation marks", "should be revised for clarity",
-        "add a comma", "remove the extra asterisk", "separate it from",
-        "comma after", "congruent with", "corrected to a standard format"
-    ]
-
-    lines = [line for line in result.splitlines() if line.strip()]
-    if not lines:
-        return True
-
-    # حساب نسبة الملاحظات التافهة
-    harmless_count = sum(1 for line in lines if any(kw in line.lower() for kw in ignore_keywords))
-    harmless_ratio = harmless_count / len(lines)
-
-    # إذا كل أو أغلب الملاحظات تافهة → نعتبرها False Positive
-    return harmless_ratio >= 0.7
+    lines = result.splitlines()
+    total = 0
+    harmless = 0
 
+    # مرور واحد مع خروج مبكر بمجرد أن تُحسم النتيجة مهما كانت الأسطر المتبقية
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        total += 1
+        if TRIVIAL_RE.search(line):
+            harmless += 1
 
-def check_grammar(content):
-    try:
-        import openai
-        client = openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+        remaining = len(lines) - i - 1
+        # حتى لو كانت كل الأسطر المتبقية مهمة تبقى النسبة ≥ 0.7
+        if harmless >= FALSE_POSITIVE_RATIO * (total + remaining):
+            return True
+        # حتى لو كانت كل الأسطر المتبقية تافهة لن تصل النسبة إلى 0.7
+        if harmless + remaining < FALSE_POSITIVE_RATIO * (total + remaining):
+            return False
+
+    # لا توجد ملاحظات، أو كل الأسطر المتبقية فارغة
+    return total == 0 or harmless >= FALSE_POSITIVE_RATIO * total
+
+
+def prepare_for_grammar(content):
+    # حذف العبارات المتكررة والتذييلات من النص قبل الإرسال إلى GPT
+    # (بما أنها محذوفة فلا داعي لإرسال قائمة الاستثناءات مع الـ Prompt)
+    content = EXCLUDED_RE.sub("", content)
+    content = FOOTER_RE.sub("", content)
+    # إرسال الفقرات غير المكررة فقط
+    return "\n".join(dict.fromkeys(
+        line.strip() for line in content.splitlines() if line.strip()
+    ))
+
+
+def clean_grammar_result(result):
+    # إذا النتيجة False Positive → ترجع OK
+    if is_false_positive_grammar(result):
+        return "OK"
 
-        # حذف العبارات المتكررة من النص قبل الإرسال إلى GPT
-        for phrase in EXCLUDED_WORDS:
-            content = content.replace(phrase, "")
+    # فلترة الملاحظات بعد الرد من GPT
+    filtered_issues = [line for line in result.splitlines() if not IGNORED_ISSUE_RE.search(line)]
 
-        excluded_text = "\n".join(EXCLUDED_WORDS)
+    # إذا لا يوجد ملاحظات مهمة بعد الفلترة → OK
+    return "\n".join(filtered_issues).strip() if filtered_issues else "OK"
 
+
+def check_grammar(content):
+    # نفس المحتوى سبق فحصه → نرجع النتيجة المحفوظة بدون استدعاء GPT
+    h = content_hash(content)
+    try:
+        cached = lookup_grammar(h)
+        print("🗃️ Grammar result served from cache", flush=True)
+        return cached
+    except KeyError:
+        pass
+
+    try:
         # إعداد الـ Prompt
         prompt = (
             "Check grammar and spelling mistakes of the news item below. "
             "If there are no mistakes, reply: OK. "
             "If there are any mistakes, reply: Caution, and list all found mistakes.\n\n"
-            "Do NOT check or modify the following words or phrases even if they seem wrong:\n"
-            f"{excluded_text}\n\n"
-            + content
+            + prepare_for_grammar(content)
         )
 
         print("🧠 Sending content to OpenAI for grammar check...", flush=True)
 
         # طلب التصحيح من GPT
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = OPENAI_CLIENT.chat.completions.create(
+            model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": "You are a grammar checker."},
                 {"role": "user", "content": prompt}
@@ -302,37 +535,17 @@ def check_grammar(content):
         )
 
         # النتيجة الأولية من GPT
-        result = response.choices[0].message.content.strip()
-
-        # إذا النتيجة False Positive → ترجع OK
-        if is_false_positive_grammar(result):
-            return "OK"
-
-        # فلترة الملاحظات بعد الرد من GPT
-        ignore_keywords = [
-            "capitalized", "capitalize", "comma", "period", "punctuation", "space", "spacing",
-            "hyphen", "dash", "format", "date", "duplicate", "redundancy", "unclear",
-            "terms-and-conditions", "voice reader", "r101"
-        ]
-        filtered_issues = []
-        for line in result.splitlines():
-            if not any(kw in line.lower() for kw in ignore_keywords):
-                filtered_issues.append(line)
-
-        # إذا لا يوجد ملاحظات مهمة بعد الفلترة → OK
-        result = "\n".join(filtered_issues).strip() if filtered_issues else "OK"
+        result = clean_grammar_result((response.choices[0].message.content or "").strip())
 
-        return result
-
-    except openai.error.RateLimitError:
+    except openai.RateLimitError:
         print("❌ Rate limit exceeded – please check your OpenAI usage quota.", flush=True)
         return "Error during grammar check: Rate limit exceeded"
 
-    except openai.error.AuthenticationError:
+    except openai.AuthenticationError:
         print("❌ Authentication failed – please verify your OpenAI API key.", flush=True)
         return "Error during grammar check: Authentication failed"
 
-    except openai.error.OpenAIError as e:
+    except openai.OpenAIError as e:
         print(f"❌ OpenAI API error: {e}", flush=True)
         return f"Error during grammar check: {str(e)}"
 
@@ -340,17 +553,104 @@ def check_grammar(content):
         print(f"❌ Unknown error during grammar check: {e}", flush=True)
         return f"Error during grammar check: {str(e)}"
 
+    # فشل الحفظ في الكاش لا يُسقط نتيجة فحص تمت بالفعل
+    try:
+        cache_grammar(h, result)
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not cache grammar result: {e}", flush=True)
+    return result
+
+
+# === فحص عدة أخبار في طلب واحد ===
+GRAMMAR_BATCH_SIZE = 10  # حد أقصى للأخبار في الطلب الواحد حتى لا نتجاوز نافذة الـ tokens
+
+def request_grammar_batch(contents):
+    """
+    ترسل مجموعة أخبار في Prompt واحد وترجع dict من رقم الخبر إلى رد GPT الخام.
+    """
+    docs = [{"id": i, "text": prepare_for_grammar(content)} for i, content in enumerate(contents)]
+    prompt = (
+        "Check grammar and spelling mistakes of each news item in the JSON below. "
+        "For each item, if there are no mistakes, its issues are: OK. "
+        "If there are any mistakes, its issues are: Caution, followed by all found mistakes, one per line.\n"
+        'Reply with JSON only, in the form {"results": [{"id": <id>, "issues": "<issues>"}]}, '
+        "with one entry for every item.\n\n"
+        + json.dumps({"docs": docs}, ensure_ascii=False)
+    )
+
+    print(f"🧠 Sending {len(contents)} articles to OpenAI in one grammar check...", flush=True)
+
+    response = OPENAI_CLIENT.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": "You are a grammar checker."},
+            {"role": "user", "content": prompt}
+        ]
+    )
+
+    reply = response.choices[0].message.content or ""
+    # أحيانًا يُحاط الـ JSON بعلامات ```json
+    reply = reply[reply.find("{"):reply.rfind("}") + 1]
+    replies = {}
+    for item in json.loads(reply)["results"]:
+        issues = item["issues"]
+        # أحيانًا ترجع الملاحظات كقائمة أسطر بدل نص واحد
+        if isinstance(issues, list) and all(isinstance(line, str) for line in issues):
+            issues = "\n".join(issues)
+        # أي شكل آخر غير متوقع → الخبر يُفحص منفردًا عبر check_grammar
+        if isinstance(issues, str):
+            replies[int(item["id"])] = issues.strip()
+    return replies
+
+
+def check_grammar_batch(contents):
+    """
+    مثل check_grammar لكن لقائمة أخبار: النتائج المحفوظة من الكاش، والباقي في طلبات مجمّعة.
+    أي خبر لا يرجع له رد صالح يُفحص منفردًا عبر check_grammar.
+    """
+    results = [None] * len(contents)
+    hashes = [content_hash(content) for content in contents]
+    pending = []
+
+    for i, h in enumerate(hashes):
+        try:
+            results[i] = lookup_grammar(h)
+        except KeyError:
+            pending.append(i)
+
+    for start in range(0, len(pending), GRAMMAR_BATCH_SIZE):
+        batch = pending[start:start + GRAMMAR_BATCH_SIZE]
+        if len(batch) > 1:
+            try:
+                replies = request_grammar_batch([contents[i] for i in batch])
+                for pos, i in enumerate(batch):
+                    if pos in replies:
+                        results[i] = clean_grammar_result(replies[pos])
+                        try:
+                            cache_grammar(hashes[i], results[i])
+                        except sqlite3.Error as e:
+                            print(f"⚠️ Could not cache grammar result: {e}", flush=True)
+            except Exception as e:
+                # أي خطأ في الدفعة (رد غير صالح، OpenAI...) لا يُسقط الدورة كلها
+                print(f"⚠️ Batched grammar check failed, checking one by one: {e}", flush=True)
+
+        for i in batch:
+            if results[i] is None:
+                results[i] = check_grammar(contents[i])
+
+    return results
+
 # دالة التحقق من الأخطاء في Table A
 def check_table_a_violations(content):
     violations = []
-    for official in TABLE_A_NAMES:
+    content_lower = content.lower()  # تحويل النص مرة واحدة فقط
+    for official, official_lower in TABLE_A_NAMES_LOWER:
         # تحقق من وجود الاسم بالضبط (حساس لحالة الأحرف)
         if official not in content:
             # لو كان موجود بصيغة خاطئة (مثلاً بدون أحرف كبيرة)
-            for line in content.splitlines():
-                if official.lower() in line.lower():
-                    violations.append(f"- Incorrect form or casing: Expected '{official}'")
-                    break
+            # الأسماء لا تحتوي على أسطر جديدة، فالبحث في النص كاملًا يكافئ البحث سطرًا سطرًا
+            if official_lower in content_lower:
+                violations.append(f"- Incorrect form or casing: Expected '{official}'")
     return violations
 #دالة فحص Table B
 def check_table_b_violations(content):
@@ -363,6 +663,13 @@ def check_table_b_violations(content):
 
 
 # دالة فحص قواعد Table C
+# التعابير تُجمَّع مرة واحدة عند التحميل بدل البحث عنها في كاش re مع كل خبر
+PAST_TENSE_HEADLINE_WORDS = ("started", "concluded")
+SUBJECT_VERB_RE = re.compile(r"\bMinister[s]?, [A-Z][a-z]+ [A-Z][a-z]+ discuss(es)? cooperation\b")
+COMMON_TYPOS = ("meat in Cairo", "sing MoU")
+PUNCTUATION_RE = re.compile(r"\s+,|\.\.")
+THE_MINISTER_RE = re.compile(r"\bThe Minister\b")
+
 def check_table_c_rules(content):
     violations = []
     lines = content.splitlines()
@@ -376,7 +683,7 @@ def check_table_c_rules(content):
     # ✅ Rule 2: استخدم زمن المضارع في العنوان
     # مثال: avoid "started" → use "starts"
     headline_lower = lines[0].lower() if lines else ""
-    if "started" in headline_lower or "concluded" in headline_lower:
+    if any(word in headline_lower for word in PAST_TENSE_HEADLINE_WORDS):
         violations.append("Rule 2 Violation: Headline uses past tense instead of present")
 
     # ✅ Rule 3: علامات اقتباس مزدوجة غير مقبولة
@@ -384,7 +691,7 @@ def check_table_c_rules(content):
         violations.append("Rule 3 Violation: Use single quotes (‘ ’) instead of double quotes (“ ”)")
 
     # ✅ Rule 4: Subject-Verb Agreement
-    if re.search(r"\bMinister[s]?, [A-Z][a-z]+ [A-Z][a-z]+ discuss(es)? cooperation\b", content):
+    if SUBJECT_VERB_RE.search(content):
         violations.append("Rule 4 Violation: Subject-verb agreement issue (use 'discuss' with plural)")
 
     # ✅ Rule 5: استخدام prepositions الخاطئة
@@ -392,21 +699,57 @@ def check_table_c_rules(content):
         violations.append("Rule 5 Violation: Use 'in Riyadh' instead of 'at Riyadh'")
 
     # ✅ Rule 6: Spelling common mistakes
-    if "meat in Cairo" in content or "sing MoU" in content:
+    if any(typo in content for typo in COMMON_TYPOS):
         violations.append("Rule 6 Violation: Likely typo - check 'meat' or 'sing'")
 
     # ✅ Rule 7: علامات ترقيم (مثل وجود مسافة قبل الفاصلة)
-    if re.search(r"\s+,", content) or re.search(r"\.\.", content):
+    if PUNCTUATION_RE.search(content):
         violations.append("Rule 7 Violation: Improper punctuation spacing or repeated dots")
 
     # ✅ Rule 8: استخدام "The Minister" بحروف كبيرة في السياق
-    if re.search(r"\bThe Minister\b", content):
+    if THE_MINISTER_RE.search(content):
         violations.append("Rule 8 Violation: Use lowercase 'the minister' in running text")
 
     return violations
 
 
 # === إرسال البريد الإلكتروني ===
+# اتصال SMTP واحد يُعاد استخدامه بدل (اتصال + STARTTLS + LOGIN) لكل رسالة،
+# ويُغلق في نهاية كل دورة فحص
+SMTP_CONN = None
+SMTP_LOCK = threading.Lock()
+
+def get_smtp():
+    global SMTP_CONN
+    if SMTP_CONN is not None:
+        try:
+            SMTP_CONN.noop()
+            return SMTP_CONN
+        except (smtplib.SMTPException, OSError):
+            SMTP_CONN = None  # انقطع الاتصال → نعيد الاتصال
+
+    smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    try:
+        smtp.starttls()
+        smtp.login(EMAIL_SENDER, EMAIL_PASSWORD)
+    except Exception:
+        smtp.close()  # لا نترك الاتصال مفتوحًا إذا فشل التشفير أو تسجيل الدخول
+        raise
+    SMTP_CONN = smtp
+    return smtp
+
+def close_smtp():
+    global SMTP_CONN
+    with SMTP_LOCK:
+        if SMTP_CONN is not None:
+            try:
+                SMTP_CONN.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            SMTP_CONN = None
+
+atexit.register(close_smtp)
+
 def send_email(subject, body):
     try:
         msg = EmailMessage()
@@ -415,106 +758,168 @@ def send_email(subject, body):
         msg["Subject"] = subject
         msg.set_content(body)
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-            smtp.starttls()
-            smtp.login(EMAIL_SENDER, EMAIL_PASSWORD)
-            smtp.send_message(msg)
+        with SMTP_LOCK:
+            get_smtp().send_message(msg)
         print(f"📧 Email sent: {subject}", flush=True)
     except Exception as e:
         print(f"❌ Error sending email: {e}", flush=True)
 
+# === تجهيز تقرير الخبر ===
+def build_email(i, url, content, result):
+    # 2. Table A: Official Names Check
+    table_a_issues = check_table_a_violations(content)
+
+    # 3. Table B: Region Names Check
+    table_b_issues = check_table_b_violations(content)
+
+    # 4. Table C: Writing Rules Check
+    table_c_issues = check_table_c_rules(content)
+
+    # 5. Collect all issue types
+    issues = []
+    # الفحص المتخطى يظهر في نص الرسالة لكنه لا يُحسب كخطأ لغوي
+    if result.strip() not in ("OK", GRAMMAR_SKIPPED) and not is_false_positive_grammar(result):
+        issues.append("grammar and spell")
+    if table_a_issues:
+        issues.append("Table A")
+    if table_b_issues:
+        issues.append("Table B")
+    if table_c_issues:
+        issues.append("Table C")
+
+    subject = "✅ OK" if not issues else f"⚠️ caution, {' and '.join(issues)}"
+
+    # 6. Compose email body
+    if subject == "OK":
+        body = (
+            f"Subject: OK\n"
+            f"News Number: #{i + 1}\n"
+            f"News Link: {url}\n"
+            f"Status: No major issues found."
+        )
+    else:
+        # تجميع الأجزاء ثم join واحد بدل إعادة بناء النص مع كل +=
+        parts = [
+            f"Subject: {subject}\n"
+            f"News Number: #{i + 1}\n"
+            f"News Link: {url}\n"
+            f"Issue(s) Found:\n"
+        ]
+
+        if result != "OK":
+            parts.append("\nGrammar/Spelling:\n")
+            parts.append(result if isinstance(result, str) else "\n".join(result))
+
+        if table_a_issues:
+            parts.append("\n\nTable A (Titles/Names):\n")
+            parts.append("\n".join(table_a_issues))
+
+        if table_b_issues:
+            parts.append("\n\nTable B (Regions/Cities):\n")
+            parts.append("\n".join(table_b_issues))
+
+        if table_c_issues:
+            parts.append("\n\nTable C (Writing Rules):\n")
+            parts.append("\n".join(table_c_issues))
+
+        body = "".join(parts)
+
+    return subject, body
+
 # === تنفيذ المهمة ===
-def monitor_news():
+LATIN_RE = re.compile(r"[A-Za-z]")
+
+def has_checkable_content(prepared):
+    # يُفحص النص بعد prepare_for_grammar: صفحة كلها عبارات ثابتة تصبح فارغة بعد التنظيف
+    # محتوى قصير جدًا أو بلا نص إنجليزي → لا داعي لاستدعاء GPT (فحص الجداول يتم على أي حال)
+    return len(prepared) >= MIN_CONTENT_CHARS and bool(LATIN_RE.search(prepared))
+
+def report_article(i, url, content, result):
+    print(f"🔎 Grammar result: {result}", flush=True)
+    subject, body = build_email(i, url, content, result)
+
+    # 7. Send email
+    send_email(subject, body)
+    print(f"📧 Email sent: {subject}", flush=True)
+
+async def monitor_news():
     try:
         print("🔍 Checking SPA news...", flush=True)
-        urls = get_latest_news_urls()
-
+        urls = await asyncio.to_thread(get_latest_news_urls)
+        # نفس الخبر قد يظهر في أكثر من قسم في الصفحة → إزالة التكرار مع الحفاظ على الترتيب
+        # (التكرار → Bloom filter → تأكيد من SQLite → المعالجة)
+        urls = list(dict.fromkeys(urls))
+        visited = get_visited_set(urls)
+
+        # استخراج المحتوى (متصفح واحد، خبر تلو الآخر)
+        articles = []
+        done = []
         for i, url in enumerate(urls):
-            if not is_visited(url):
-                print(f"📰 New article: {url}", flush=True)
-                content = extract_news_content(url)
-                print(f"📄 Content length: {len(content)}", flush=True)
-
-                if content:
-                    # 1. Grammar & Spelling Check
-                    result = check_grammar(content)
-                    print(f"🔎 Grammar result: {result}", flush=True)
-
-                    # 2. Table A: Official Names Check
-                    table_a_issues = check_table_a_violations(content)
-
-                    # 3. Table B: Region Names Check
-                    table_b_issues = check_table_b_violations(content)
-
-                    # 4. Table C: Writing Rules Check
-                    table_c_issues = check_table_c_rules(content)
-
-                    # 5. Collect all issue types
-                    issues = []
-                    if result.strip() != "OK" and not is_false_positive_grammar(result):
-                        issues.append("grammar and spell")
-                    if table_a_issues:
-                        issues.append("Table A")
-                    if table_b_issues:
-                        issues.append("Table B")
-                    if table_c_issues:
-                        issues.append("Table C")
-
-                    subject = "✅ OK" if not issues else f"⚠️ caution, {' and '.join(issues)}"
-
-                    # 6. Compose email body
-                    if subject == "OK":
-                        body = (
-                            f"Subject: OK\n"
-                            f"News Number: #{i + 1}\n"
-                            f"News Link: {url}\n"
-                            f"Status: No major issues found."
-                        )
-                    else:
-                        body = (
-                            f"Subject: {subject}\n"
-                            f"News Number: #{i + 1}\n"
-                            f"News Link: {url}\n"
-                            f"Issue(s) Found:\n"
-                        )
-
-                        if result != "OK":
-                            body += "\nGrammar/Spelling:\n"
-                            body += result if isinstance(result, str) else "\n".join(result)
-
-                        if table_a_issues:
-                            body += "\n\nTable A (Titles/Names):\n"
-                            body += "\n".join(table_a_issues)
-
-                        if table_b_issues:
-                            body += "\n\nTable B (Regions/Cities):\n"
-                            body += "\n".join(table_b_issues)
-
-                        if table_c_issues:
-                            body += "\n\nTable C (Writing Rules):\n"
-                            body += "\n".join(table_c_issues)
-
-                    # 7. Send email
-                    send_email(subject, body)
-                    print(f"📧 Email sent: {subject}", flush=True)
-
-                else:
-                    print("⚠️ No content extracted.", flush=True)
-
-                mark_visited(url)
+            if url in visited:
+                continue
+            print(f"📰 New article: {url}", flush=True)
+            content = await asyncio.to_thread(extract_news_content, url)
+            print(f"📄 Content length: {len(content)}", flush=True)
+
+            if not content.strip():
+                print("⚠️ No content extracted.", flush=True)
+                done.append(url)
+                continue
+            prepared = prepare_for_grammar(content)
+            checkable = has_checkable_content(prepared)
+            if not checkable:
+                print(
+                    f"⚠️ Content too short/degraded ({len(prepared)} chars after cleanup), "
+                    "skipping grammar check",
+                    flush=True
+                )
+            articles.append((i, url, content, checkable))
+
+        # 1. Grammar & Spelling Check: كل الأخبار الصالحة في طلبات مجمّعة
+        # الأخبار المستثناة تُعلَّم كمتخطاة (لا كـ OK)، وتبقى فحوصات Table A/B/C عليها
+        to_check = [n for n, (_, _, _, checkable) in enumerate(articles) if checkable]
+        checked = await asyncio.to_thread(
+            check_grammar_batch, [articles[n][2] for n in to_check]
+        )
+        results = [GRAMMAR_SKIPPED] * len(articles)
+        for n, result in zip(to_check, checked):
+            results[n] = result
+
+        # 2-7. فحص الجداول وإرسال التقارير واحدًا تلو الآخر (اتصال SMTP واحد للدورة)؛
+        # خطأ في خبر واحد لا يوقف بقية الأخبار
+        for (i, url, content, _), result in zip(articles, results):
+            try:
+                await asyncio.to_thread(report_article, i, url, content, result)
+                done.append(url)
+            except Exception as e:
+                print(f"❌ Error while processing article: {e}", flush=True)
+
+        if done:
+            mark_visited_many(done)
 
     except Exception as e:
         print(f"❌ Error in monitor_news(): {e}", flush=True)
 
+    finally:
+        # اتصال SMTP واحد لكل دورة: Gmail يغلق الاتصالات الخاملة قبل الدورة التالية على أي حال
+        await asyncio.to_thread(close_smtp)
+
 # === الجدولة والتشغيل ===
+CHECK_INTERVAL = 5 * 60  # ثوانٍ بين كل فحص
+
+async def scheduler_loop():
+    next_run = time.monotonic()
+    while True:
+        await monitor_news()  # أول تشغيل مباشر عند البدء
+        # النوم حتى موعد الفحص التالي بالضبط بدل الاستيقاظ كل 10 ثوانٍ؛
+        # إذا تجاوز الفحص مدته يبدأ التالي فورًا
+        next_run = max(next_run + CHECK_INTERVAL, time.monotonic())
+        await asyncio.sleep(next_run - time.monotonic())
+
 def run_scheduler():
     print("🟢 SPA News Monitor Service Started.", flush=True)
     init_db()
-    monitor_news()  # تشغيل مباشر عند البدء
-    schedule.every(5).minutes.do(monitor_news)
-    while True:
-        schedule.run_pending()
-        time.sleep(10)
+    asyncio.run(scheduler_loop())
 
 if __name__ == "__main__":
     run_scheduler()